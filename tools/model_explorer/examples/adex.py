@@ -5,6 +5,7 @@ Adaptive exponential integrate and fire model explorer
 In this example, you can modify the parameters of the (reduced) adaptive exponential
 integrate and fire model.
 '''
+import sys
 from brian2 import *
 from model_explorer import *
 
@@ -14,58 +15,111 @@ from model_explorer import *
 G = None
 spikemon = None
 statemon = None
+net = None
 cur_Nr = None
+cur_raster = None
+cur_dtype = None
+cur_eqs = None
+base_dt = 0.1*ms
 
 def get_adex_data(model,
                   taum, tauw,
                   a, b,
                   DeltaT, EL, VT, Vr,
-                  duration, silent, Imin, Imax, N, repeats,
+                  duration, silent, Imin, Imax, N, repeats, raster,
                   ):
-    global G, spikemon, statemon, cur_Nr, cur_eqs
+    global G, spikemon, statemon, net, cur_Nr, cur_raster, cur_dtype, cur_eqs
     
     Vcut = VT + 5 * DeltaT
     Nr = N*repeats
     
+    # Brian chooses the integration method from the equations: without the exponential
+    # term (LIF, DeltaT=0) they are linear and are integrated exactly
     if DeltaT>0:
-        DeltaT_min = DeltaT
+        eqs = '''
+        dvm/dt = ((EL-vm)+DeltaT*exp((vm-VT)/DeltaT)+I-w)/taum : volt
+        dw/dt = (a*(vm-EL)-w)/tauw : volt
+        I : volt
+        '''
     else:
-        DeltaT_min = 1*volt
+        eqs = '''
+        dvm/dt = ((EL-vm)+I-w)/taum : volt
+        dw/dt = (a*(vm-EL)-w)/tauw : volt
+        I : volt
+        '''
+    # count spikes per neuron for the f-I curve, only record all spikes for the raster plot
+    eqs, reset = add_spike_counter(eqs, 'vm = Vr; w += b')
         
-    eqs = '''
-    dvm/dt = ((EL-vm)+DeltaT*exp((vm-VT)/DeltaT_min)+I-w)/taum : volt
-    dw/dt = (a*(vm-EL)-w)/tauw : volt
-    I : volt
-    '''
+    # the model may be run in single or double precision
+    dtype = prefs['core.default_float_dtype']
         
-    if cur_Nr!=Nr:
-        G = NeuronGroup(Nr, eqs, threshold='vm>Vcut', reset='vm = Vr; w += b')
+    # previews use a coarser time step, which has to stay well below the time constants
+    # unless the equations are integrated exactly
+    if DeltaT>0:
+        dt = model.time_step(base_dt, max_dt=min(taum, tauw)/10)
+    else:
+        dt = model.time_step(base_dt)
+        
+    if cur_Nr!=Nr or cur_raster!=raster or cur_dtype!=dtype or cur_eqs!=eqs:
+        G = NeuronGroup(Nr, eqs, threshold='vm>Vcut', reset=reset)
         model.update() # maintain responsiveness of gui
-        spikemon = SpikeMonitor(G)
+        if raster:
+            spikemon = SpikeMonitor(G)
+        else:
+            spikemon = None
         model.update() # maintain responsiveness of gui
         statemon = StateMonitor(G, variables=['vm', 'w'], record=[0, Nr/3, 2*Nr/3, Nr-1])
         model.update() # maintain responsiveness of gui
+        # a group can only be simulated in one network, so the network is reused and reset to
+        # this initial state (time and recorded monitor data) for each computation
+        if raster:
+            net = Network(G, spikemon, statemon)
+        else:
+            net = Network(G, statemon)
+        net.store()
         cur_Nr = Nr
+        cur_raster = raster
+        cur_dtype = dtype
+        cur_eqs = eqs
 
-    spikemon.resize(0)
-    statemon.resize(0)
+    net.restore()
+    # restoring the network also restores the time step it was stored with
+    defaultclock.dt = dt
     G.vm = EL
     G.I = repeat(linspace(Imin, Imax, N), repeats)
     G.w = 0
-    @network_operation
-    def up():
-        model.update(defaultclock.t/duration)
-    net = Network(G, spikemon, statemon, up)
-    net.run(duration)
-    net.remove(spikemon)
+    G.spike_count = 0
+    if raster:
+        spikemon.active = True
+    # constants used in the equations, they are not looked up in this function by run_network
+    namespace = {'taum': taum, 'tauw': tauw, 'a': a, 'b': b, 'DeltaT': DeltaT,
+                 'EL': EL, 'VT': VT, 'Vr': Vr, 'Vcut': Vcut}
+    # progress is split between the stimulus and the silent period by their durations
+    if duration+silent>0:
+        stimulus_fraction = float(duration/(duration+silent))
+    else:
+        stimulus_fraction = 1.0
+    model.run_network(net, duration, 0.0, stimulus_fraction, namespace=namespace)
+    counts = array(G.spike_count, dtype=int)
+    if raster:
+        spikemon.active = False
+        # copies, since the monitor's variables are views that cannot be pickled or sent
+        spikes = spikemon.i[:], spikemon.t[:]
+    else:
+        spikes = None
     G.I = 0
-    net.run(silent)
-    return spikemon.it, statemon.t, statemon.vm, statemon.w
+    model.run_network(net, silent, stimulus_fraction, 1.0, namespace=namespace)
+    return spikes, counts, statemon.t[:], statemon.vm[:], statemon.w[:]
     
     
 class AdExModel(ExplorableModel):
     explorer_type = 'adex'
     plot_styles = ['standard']
+    # show results at a coarse time step first, refined once parameters stop changing
+    preview = True
+    preview_error_budget = 0.5*ms
+    # spikes missing in either of two compared results count as a 10 ms timing error
+    unmatched_error = 10*ms
     param_specs = [
         'Time constants',
         
@@ -106,25 +160,49 @@ class AdExModel(ExplorableModel):
                   description='Number of input current values'),
         Parameter('repeats', 1, 1, 100, 5,
                   description='Number of repeats of each input current'),
+        BooleanParameter('raster', True,
+                         description='Record all spikes for the raster plot (otherwise only spike counts)'),
         ]
     
     def get_data(self, **params):
         return get_adex_data(self, **params), params
+    
+    def preview_error(self, preview, data):
+        (spikes_preview, counts_preview, _, _, _), _ = preview
+        (spikes, counts, _, _, _), params = data
+        unmatched_error = self.unmatched_error
+        if spikes is not None and spikes_preview is not None:
+            return spike_timing_error(spikes_preview, spikes, float(unmatched_error))*second
+        total = max(sum(counts), 1)
+        return sum(abs(counts_preview-counts))*unmatched_error/total
+    
+    def precision_deviations(self, reference, data):
+        (spikes_ref, counts_ref, _, vm_ref, w_ref), params = reference
+        (spikes, counts, _, vm, w), _ = data
+        # spike trains may differ in length, so they are compared by spike timing
+        deviations = (compare_data(counts_ref, counts, 'spike counts')+
+                      compare_data(vm_ref, vm, 'vm')+
+                      compare_data(w_ref, w, 'w'))
+        if spikes_ref is not None and spikes is not None:
+            error = spike_timing_error(spikes_ref, spikes, float(self.unmatched_error))
+            deviations.append(('spike times', error, error/max(float(params['duration']), 1e-3)))
+        return deviations
 
     def plot_data(self, fig, style, data):
-        ((i, t), times, vm, w), params = data
+        (spikes, counts, times, vm, w), params = data
         fig.clear()
         
         # raster
         ax_raster = ax = fig.add_subplot(221)
-        ax.plot(t/ms, i, ',k')
+        if spikes is not None:
+            i, t = spikes
+            ax.plot(t/ms, i, ',k')
         ax.set_xlabel('Time (ms)')
         ax.set_ylabel('Neuron index')
         
         # f-I
         ax = fig.add_subplot(222)
-        counts = bincount(i/params['repeats'], minlength=params['N'])
-        rates = counts*1.0/params['repeats']/params['duration']
+        rates = bucket_rates(counts, params['repeats'], params['duration'])
         I = linspace(params['Imin'], params['Imax'], params['N'])
         ax.plot(I/mV, rates)
         ax.set_xlabel('Input (mV)')
@@ -143,5 +221,11 @@ class AdExModel(ExplorableModel):
         ax.set_ylabel('w (mV)')
 
 if __name__=='__main__':
+    # Use AdExModel(precision='single') for faster, more compact simulations. Run
+    # "python adex.py validate" to check its deviation from double precision.
     model = AdExModel()
-    model.launch_gui()
+    if len(sys.argv)>1 and sys.argv[1]=='validate':
+        for name, abs_dev, rel_dev in model.validate_precision(**default_params(model)):
+            print('%s: max. deviation %g (SI units), %.3g%% relative' % (name, abs_dev, 100*rel_dev))
+    else:
+        model.launch_gui()
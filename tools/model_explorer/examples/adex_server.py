@@ -0,0 +1,27 @@
+'''
+Adaptive exponential integrate and fire model explorer with a compute server
+----------------------------------------------------------------------------
+
+Runs the simulations of the AdEx model explorer (see adex.py) in a separate server process.
+Start the server first, then any number of explorer windows::
+
+    python adex_server.py server [PORT]
+    python adex_server.py client [HOST] [PORT]
+
+To use a server on another machine, forward its port with e.g.
+``ssh -L 21567:localhost:21567 HOST`` and connect to localhost.
+'''
+import sys
+from brian2 import *
+from model_explorer import *
+from adex import AdExModel
+
+if __name__=='__main__':
+    command = sys.argv[1]
+    if command=='server':
+        port = int(sys.argv[2]) if len(sys.argv)>2 else default_port
+        serve([AdExModel()], port=port)
+    elif command=='client':
+        host = sys.argv[2] if len(sys.argv)>2 else 'localhost'
+        port = int(sys.argv[3]) if len(sys.argv)>3 else default_port
+        RemoteModel(AdExModel(), host=host, port=port).launch_gui()
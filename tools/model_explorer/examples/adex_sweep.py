@@ -0,0 +1,37 @@
+'''
+Adaptive exponential integrate and fire parameter sweep
+-------------------------------------------------------
+
+Runs a sweep over the adaptation parameters of the AdEx model explorer (see adex.py) using a
+job queue in a directory. If the directory is on a shared file system, workers can be started
+on any number of machines, and the sweep can be resumed if it was interrupted::
+
+    python adex_sweep.py DIRECTORY enqueue      # add the jobs to the queue
+    python adex_sweep.py DIRECTORY work         # run a worker process
+    python adex_sweep.py DIRECTORY local        # run one worker per CPU on this machine
+    python adex_sweep.py DIRECTORY status       # show the progress of the sweep
+    python adex_sweep.py DIRECTORY gallery      # render the results in DIRECTORY/gallery
+'''
+import os
+import sys
+from brian2 import *
+from model_explorer import *
+from adex import AdExModel
+
+if __name__=='__main__':
+    directory, command = sys.argv[1:3]
+    model = AdExModel()
+    if command=='enqueue':
+        params = default_params(model)
+        params['raster'] = False
+        grid = parameter_grid(params,
+                              a=linspace(0, 10, 11),
+                              b=linspace(0, 100, 11)*mV)
+        SweepQueue(directory).enqueue(grid)
+    elif command=='work':
+        run_worker(model, directory)
+    elif command=='local':
+        run_local_workers(model, directory)
+    elif command=='gallery':
+        render_gallery(model, SweepQueue(directory).results(), os.path.join(directory, 'gallery'))
+    print(SweepQueue(directory).status())
@@ -1 +1,5 @@
 from .model_explorer import *
+from .session import *
+from .sweep import *
+from .server import *
+from .gallery import *
@@ -0,0 +1,157 @@
+'''
+Rendering galleries of model results without a GUI
+
+``render_gallery`` calls the ``plot_data`` method of a model on Agg figures for each result
+and each of its ``plot_styles``, in a pool of processes. It writes full size images and
+thumbnails, and an index (``index.json`` and ``index.html``) for browsing them. Results whose
+data has not changed since the last rendering are not rendered again. Layout of the directory::
+
+    images/<name>_<style>.png       full size images
+    thumbnails/<name>_<style>.png   thumbnails
+    index.json                      params, data hash and image files of each result
+    index.html                      table of thumbnails linking to the full size images
+'''
+import os
+import json
+import hashlib
+import binascii
+import multiprocessing
+
+import numpy
+import matplotlib.image
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from .model_explorer import ensure_directory, try_tight_layout, brian2
+
+__all__ = ['render_gallery', 'data_hash']
+
+
+def _digest(value):
+    h = hashlib.sha1()
+    if isinstance(value, (tuple, list)):
+        h.update(('%s:%d' % (type(value).__name__, len(value))).encode('utf-8'))
+        for item in value:
+            h.update(_digest(item))
+    elif isinstance(value, dict):
+        # the order of the items of a dict is arbitrary
+        h.update(('dict:%d' % len(value)).encode('utf-8'))
+        for item in sorted(_digest(k)+_digest(v) for k, v in value.items()):
+            h.update(item)
+    elif isinstance(value, numpy.ndarray):
+        if value.dtype.hasobject:
+            raise TypeError('Cannot hash arrays of Python objects')
+        h.update(('array:%s:%r' % (value.dtype.str, value.shape)).encode('utf-8'))
+        if brian2 is not None and isinstance(value, brian2.Quantity):
+            dims = [float(d) for d in brian2.get_dimensions(value)._dims]
+            h.update(('dim:%r' % dims).encode('utf-8'))
+        h.update(numpy.ascontiguousarray(value).tobytes())
+    else:
+        if isinstance(value, numpy.generic):
+            value = value.item()
+        h.update(('%s:%r' % (type(value).__name__, value)).encode('utf-8'))
+    return h.digest()
+
+
+def data_hash(data):
+    '''
+    Returns a hash of data (nested tuples, lists and dicts of numbers, strings and arrays)
+    '''
+    return binascii.hexlify(_digest(data)).decode('ascii')
+
+
+def _escape(s):
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+# model used by the rendering processes, set by _init_renderer
+_model = None
+
+def _init_renderer(model):
+    global _model
+    _model = model
+
+
+def _render(job):
+    name, data, images, figsize, dpi, thumbnail_scale = job
+    for style, image, thumbnail in images:
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        _model.plot_data(fig, style, data)
+        try_tight_layout(fig)
+        fig.savefig(image, dpi=dpi)
+        matplotlib.image.thumbnail(image, thumbnail, scale=thumbnail_scale)
+    return name
+
+
+def _write_html(filename, index):
+    lines = ['<html><head><title>Model explorer gallery</title></head><body>', '<table>']
+    for name in sorted(index.keys()):
+        entry = index[name]
+        params = ', '.join('%s=%s' % (k, v) for k, v in sorted(entry['params'].items()))
+        lines.append('<tr><td><b>%s</b><br/>%s</td>' % (_escape(name), _escape(params)))
+        for style, image, thumbnail in entry['images']:
+            lines.append('<td><a href="%s"><img src="%s" title="%s"/></a></td>'
+                         % (_escape(image), _escape(thumbnail), _escape(style)))
+        lines.append('</tr>')
+    lines.extend(['</table>', '</body></html>'])
+    f = open(filename, 'w')
+    f.write('\n'.join(lines)+'\n')
+    f.close()
+
+
+def render_gallery(model, results, directory, processes=None, figsize=(12, 9), dpi=80,
+                   thumbnail_scale=0.25):
+    '''
+    Renders the images of results in directory, returns the number of results rendered
+
+    ``results`` is an iterable of ``(name, params, data)``, e.g. ``SweepQueue.results()``, where
+    the name has to be usable in file names. The results are rendered in ``processes`` processes
+    (by default, one per CPU).
+    '''
+    ensure_directory(os.path.join(directory, 'images'))
+    ensure_directory(os.path.join(directory, 'thumbnails'))
+    index_filename = os.path.join(directory, 'index.json')
+    if os.path.exists(index_filename):
+        index = json.load(open(index_filename, 'r'))
+    else:
+        index = {}
+
+    def jobs():
+        for name, params, data in results:
+            h = data_hash(data)
+            images = [(style,
+                       os.path.join('images', '%s_%s.png' % (name, style)),
+                       os.path.join('thumbnails', '%s_%s.png' % (name, style)))
+                      for style in model.plot_styles]
+            entry = index.get(name)
+            if (entry is not None and entry['hash']==h and
+                    all(os.path.exists(os.path.join(directory, image)) and
+                        os.path.exists(os.path.join(directory, thumbnail))
+                        for _, image, thumbnail in images)):
+                continue
+            index[name] = {'params': dict((k, str(v)) for k, v in params.items()),
+                           'hash': h,
+                           'images': images}
+            paths = [(style, os.path.join(directory, image), os.path.join(directory, thumbnail))
+                     for style, image, thumbnail in images]
+            yield name, data, paths, figsize, dpi, thumbnail_scale
+
+    num_rendered = 0
+    if processes==1:
+        _init_renderer(model)
+        for job in jobs():
+            _render(job)
+            num_rendered += 1
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init_renderer, initargs=(model,))
+        try:
+            for _ in pool.imap_unordered(_render, jobs()):
+                num_rendered += 1
+        finally:
+            pool.close()
+            pool.join()
+
+    json.dump(index, open(index_filename, 'w'), indent=1, sort_keys=True)
+    _write_html(os.path.join(directory, 'index.html'), index)
+    return num_rendered
@@ -18,6 +18,8 @@ import re
 import multiprocessing
 import pickle
 import glob
+import time
+import json
 
 import matplotlib
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
@@ -25,11 +27,14 @@ from matplotlib.backends.backend_qt4agg import NavigationToolbar2QTAgg as Naviga
 from matplotlib.figure import Figure
 
 from copy import copy
+from contextlib import contextmanager
 
 from PyQt4 import QtCore, QtGui
 from model_explorer_ui import Ui_ModelExplorer
 
-__all__ = ['ExplorableModel', 'ModelExplorerInterruptError', 'Parameter', 'BooleanParameter']
+__all__ = ['ExplorableModel', 'ModelExplorerInterruptError', 'Parameter', 'BooleanParameter',
+           'add_spike_counter', 'bucket_rates', 'compact_data', 'compare_data',
+           'spike_timing_error']
 
 def _get_best_unit(u):
     '''
@@ -66,6 +71,141 @@ def ensure_directory(d):
     return d
 
 
+@contextmanager
+def brian_float_dtype(dtype):
+    '''
+    Temporarily sets the default floating point type used by Brian 2 for new objects
+    '''
+    if brian2 is None:
+        yield
+        return
+    prefs = getattr(brian2, 'prefs', None)
+    if prefs is None:
+        prefs = brian2.brian_prefs
+    old_dtype = prefs['core.default_float_dtype']
+    prefs['core.default_float_dtype'] = dtype
+    try:
+        yield
+    finally:
+        prefs['core.default_float_dtype'] = old_dtype
+
+
+def compact_data(data, dtype):
+    '''
+    Converts all floating point arrays in data (nested tuples, lists and dicts) to dtype
+    
+    Scalars (including 0-dimensional arrays, e.g. Brian 2 quantities) are left unchanged.
+    '''
+    if isinstance(data, tuple):
+        return tuple(compact_data(x, dtype) for x in data)
+    if isinstance(data, list):
+        return [compact_data(x, dtype) for x in data]
+    if isinstance(data, dict):
+        return dict((k, compact_data(v, dtype)) for k, v in data.items())
+    if isinstance(data, ndarray) and data.ndim>0 and data.dtype.kind=='f' and data.dtype!=dtype:
+        return data.astype(dtype)
+    return data
+
+
+def compare_data(reference, data, path='data'):
+    '''
+    Compares all arrays in data with those in reference (nested tuples, lists and dicts)
+    
+    Returns a list of ``(path, max_abs_deviation, max_rel_deviation)`` with one entry per array,
+    where the relative deviation is relative to the maximum absolute value of the reference.
+    Arrays whose shape differs get an infinite deviation, so variable length data such as spike
+    trains should be compared with e.g. ``spike_timing_error`` instead (see
+    ``ExplorableModel.precision_deviations``). Values are compared in SI units.
+    '''
+    if isinstance(reference, (tuple, list)):
+        deviations = []
+        for i, (r, d) in enumerate(zip(reference, data)):
+            deviations.extend(compare_data(r, d, '%s[%d]' % (path, i)))
+        return deviations
+    if isinstance(reference, dict):
+        deviations = []
+        for k in sorted(reference.keys()):
+            deviations.extend(compare_data(reference[k], data[k], '%s[%r]' % (path, k)))
+        return deviations
+    if not isinstance(reference, ndarray) or reference.ndim==0:
+        return []
+    reference = asarray(reference, dtype=float64)
+    data = asarray(data, dtype=float64)
+    if reference.shape!=data.shape:
+        return [(path, inf, inf)]
+    if reference.size==0:
+        return [(path, 0.0, 0.0)]
+    abs_dev = amax(abs(data-reference))
+    scale = amax(abs(reference))
+    if scale>0:
+        rel_dev = abs_dev/scale
+    else:
+        rel_dev = abs_dev
+    return [(path, abs_dev, rel_dev)]
+
+
+def add_spike_counter(eqs, reset, name='spike_count'):
+    '''
+    Returns ``(eqs, reset)`` modified so that each neuron counts its own spikes
+    
+    The count is stored in the state variable ``name``, so a model can read per-neuron spike
+    counts from the group instead of keeping every spike in a ``SpikeMonitor``. Memory use
+    then scales with the number of neurons rather than with the number of spikes.
+    '''
+    eqs = eqs+'\n%s : 1\n' % name
+    if reset:
+        reset = reset+'; %s += 1' % name
+    else:
+        reset = '%s += 1' % name
+    return eqs, reset
+
+
+def bucket_rates(counts, repeats, duration):
+    '''
+    Returns the mean firing rate for each bucket of ``repeats`` consecutive neurons
+    
+    ``counts`` are the per-neuron spike counts (e.g. from ``add_spike_counter``) over a period
+    of length ``duration``, where the neurons ``k*repeats`` to ``(k+1)*repeats-1`` share the
+    same stimulus.
+    '''
+    counts = asarray(counts, dtype=float)
+    return counts.reshape(-1, repeats).mean(axis=1)/duration
+
+
+def _spike_keys(i, t):
+    '''
+    Returns ``(keys, t)`` sorted, where the key identifies the neuron and the rank of each spike
+    '''
+    i = asarray(i, dtype=int64)
+    t = asarray(t, dtype=float64)
+    order = lexsort((t, i))
+    i = i[order]
+    t = t[order]
+    rank = arange(len(i))-searchsorted(i, i)
+    return i*2**32+rank, t
+
+
+def spike_timing_error(spikes1, spikes2, unmatched_error):
+    '''
+    Returns the mean spike timing error (in seconds) between two recordings of the same neurons
+    
+    Spikes are given as ``(i, t)`` (e.g. ``SpikeMonitor.it``). The k-th spike of a neuron in
+    spikes1 is compared to the k-th spike of the same neuron in spikes2, and each spike without
+    such a match counts as an error of ``unmatched_error`` seconds.
+    '''
+    keys1, t1 = _spike_keys(*spikes1)
+    keys2, t2 = _spike_keys(*spikes2)
+    # maximum rather than max, which is numpy's amax here
+    n = int(maximum(len(t1), len(t2)))
+    if n==0:
+        return 0.0
+    matched1 = isin(keys1, keys2)
+    matched2 = isin(keys2, keys1)
+    num_matched = sum(matched1)
+    error = sum(abs(t1[matched1]-t2[matched2]))+(n-num_matched)*unmatched_error
+    return error/n
+
+
 class Parameter(object):
     '''
     Used to specify parameter ranges
@@ -116,6 +256,28 @@ def try_tight_layout(fig):
         pass    
 
 
+class SessionRecorder(object):
+    '''
+    Records the timeline of user actions in a ``ModelExplorer`` to a file
+    
+    Each line of the file is a JSON object with the time (in seconds since the start of the
+    session) and the event, see ``replay_session``.
+    '''
+    def __init__(self, filename, explorer_type):
+        self.file = open(filename, 'w')
+        self.start_time = time.time()
+        self.record('session', explorer_type=explorer_type)
+        
+    def record(self, event, **kwds):
+        kwds['event'] = event
+        kwds['time'] = time.time()-self.start_time
+        self.file.write(json.dumps(kwds, sort_keys=True)+'\n')
+        self.file.flush()
+        
+    def close(self):
+        self.file.close()
+
+
 class SpinboxChanger(object):
     def __init__(self, model_explorer, param_name):
         self.model_explorer = model_explorer
@@ -139,7 +301,7 @@ class PageSwitcher(object):
 
 
 class ModelExplorer(QtGui.QMainWindow):
-    def __init__(self, parent=None, model=None, auto_compute=True):
+    def __init__(self, parent=None, model=None, auto_compute=True, session_file=None):
         # Do basic setup from Qt Designer
         QtGui.QWidget.__init__(self, parent)
         self.ui = Ui_ModelExplorer()
@@ -149,6 +311,16 @@ class ModelExplorer(QtGui.QMainWindow):
         self.model = model
         self.model.set_model_explorer(self)
         self.curdata = None
+        # functions called without arguments after each plot update
+        self.plot_listeners = []
+        if session_file is not None:
+            self.session_recorder = SessionRecorder(session_file, self.model.explorer_type)
+        else:
+            self.session_recorder = None
+        # refines preview results once the parameters stop changing
+        self.refine_timer = QtCore.QTimer(self)
+        self.refine_timer.setSingleShot(True)
+        QtCore.QObject.connect(self.refine_timer, QtCore.SIGNAL('timeout()'), self.refine_data)
         self.int_percent_complete = 0
         self.modifying_form_data = True
         # create plot region
@@ -233,10 +405,45 @@ class ModelExplorer(QtGui.QMainWindow):
             return
         self._initial_compute = True
         if self.auto_compute:
+            self.record_event('initial_compute')
             self.compute_data()
             
+    def record_event(self, event, **kwds):
+        if self.session_recorder is not None:
+            self.session_recorder.record(event, **kwds)
+            
+    def closeEvent(self, *args, **kwds):
+        if self.session_recorder is not None:
+            self.session_recorder.close()
+            self.session_recorder = None
+        super(ModelExplorer, self).closeEvent(*args, **kwds)
+            
+    def encode_params(self, params):
+        '''
+        Returns params as plain numbers in display units (as used by the controls)
+        '''
+        encoded = {}
+        for param_name, val in params.items():
+            if param_name in self.param_units:
+                val = val/self.param_units[param_name]
+                if not isinstance(val, int):
+                    val = float(val)
+            else:
+                val = bool(val)
+            encoded[param_name] = val
+        return encoded
+    
+    def decode_params(self, encoded):
+        params = {}
+        for param_name, val in encoded.items():
+            if param_name in self.param_units:
+                val = val*self.param_units[param_name]
+            params[param_name] = val
+        return params
+            
     def change_plot_style(self, style):
         self.cur_plot_style = str(style)
+        self.record_event('change_plot_style', style=self.cur_plot_style)
         self.update_plot()
         
     def get_saved_parameters(self, select=None):
@@ -307,20 +514,25 @@ class ModelExplorer(QtGui.QMainWindow):
                                               'the default values will be used: '+missing)
                 for k in missing_keys:
                     newparams[k] = self.default_values[k]
-            self.cur_params = newparams
-            if self.auto_compute:
-                self.compute_data()
-            self.modifying_form_data = True
-            for param_name, val in self.cur_params.items():
-                if param_name in self.param_units:
-                    self.spinboxes[param_name].setValue(val/self.param_units[param_name])
-                else:
-                    self.checkboxes[param_name].setChecked(val)
-            self.modifying_form_data = False
+            self.record_event('load_parameters', name=params, params=self.encode_params(newparams))
+            self.set_parameters(newparams)
+            
+    def set_parameters(self, newparams):
+        self.cur_params = newparams
+        if self.auto_compute:
+            self.compute_data()
+        self.modifying_form_data = True
+        for param_name, val in self.cur_params.items():
+            if param_name in self.param_units:
+                self.spinboxes[param_name].setValue(val/self.param_units[param_name])
+            else:
+                self.checkboxes[param_name].setChecked(val)
+        self.modifying_form_data = False
         
     def param_changed(self, param_name, val):
         if self.modifying_form_data:
             return
+        self.record_event('param_changed', name=param_name, value=val)
         self.ui.list_saved_params.selectionModel().clearSelection()
         QtGui.QApplication.processEvents()
         if param_name in self.param_units:
@@ -329,12 +541,35 @@ class ModelExplorer(QtGui.QMainWindow):
         if self.auto_compute:
             self.compute_data()
         
-    def compute_data(self):
-        data = self.model.compute(**self.cur_params.copy())
+    def compute_data(self, preview=None):
+        if preview is None:
+            preview = self.auto_compute and self.model.preview
+        self.model.previewing = preview
+        try:
+            data = self.model.compute(**self.cur_params.copy())
+        except IOError as e:
+            # e.g. a remote model that lost its connection or whose computation failed on the
+            # server, the next computation tries again
+            self.ui.progress_bar.setValue(0)
+            self.statusBar().showMessage(str(e))
+            return
         if data is not None:
+            self.statusBar().clearMessage()
             self.ui.progress_bar.setValue(0)
             self.curdata = data
             self.update_plot()
+            # only refine results that were computed with a coarser time step
+            if self.model.data_previewing:
+                self.refine_timer.start(int(1000*self.model.refine_delay))
+            else:
+                self.refine_timer.stop()
+            
+    def refine_data(self):
+        # Never interrupt a running computation: if it is a preview, the timer is started again
+        # once its result has been shown
+        if self.model.is_computing:
+            return
+        self.compute_data(preview=False)
     
     def update_plot(self):
         if self.curdata is None:
@@ -343,6 +578,8 @@ class ModelExplorer(QtGui.QMainWindow):
         self.model.plot_data(self.figure, self.cur_plot_style, self.curdata)
         try_tight_layout(self.figure)
         self.figure.canvas.draw()
+        for listener in self.plot_listeners:
+            listener()
         
     def update_complete(self, fraction):
         complete = int(100*fraction)
@@ -364,12 +601,29 @@ class ExplorableModel(object):
     plot_styles = None
     #: list of ``Parameter`` objects, or text for display purposes only
     param_specs = None
+    #: minimum wall-clock time (in seconds) between two GUI refreshes in ``update``
+    update_interval = 0.05
+    #: number of chunks a Brian run is split into by ``run_network``
+    run_network_chunks = 20
+    #: 'double' or 'single', the precision used for Brian 2 simulations and stored results
+    precision = 'double'
+    #: whether to compute fast previews first, refined once parameters stop changing
+    preview = False
+    #: time (in seconds) without parameter changes before a preview is refined
+    refine_delay = 0.5
+    #: maximum factor by which ``time_step`` coarsens the time step in previews
+    max_preview_dt_factor = 16
+    #: maximum acceptable value of ``preview_error``, or None to never adapt the preview time step
+    preview_error_budget = None
     
     def get_data(self, **params):
         '''
         This function should return data or None depending if the computation was interrupted.
         The function should regularly call ``self.update(fraction_complete)`` which will
         raise a ``ModelExplorerInterruptError`` if the computation should be stopped.
+        Calling ``update`` often is cheap, the GUI is only refreshed every ``update_interval``
+        seconds. For Brian networks, use ``self.run_network(net, duration)`` instead of a
+        ``network_operation`` calling ``update`` on every time step.
         '''
         pass
     
@@ -378,14 +632,45 @@ class ExplorableModel(object):
         Function should plot the data returned by get_data on the figure fig with plot style style.
         '''
         pass
+    
+    def preview_error(self, preview, data):
+        '''
+        Optionally, returns the error of the preview data compared to the exact data (e.g. a spike
+        timing error), which is compared to ``preview_error_budget`` to adapt the preview time step.
+        '''
+        return None
+    
+    def precision_deviations(self, reference, data):
+        '''
+        Returns the deviations of data (single precision) from reference (double precision) as a
+        list of ``(name, max_abs_deviation, max_rel_deviation)``. By default, all arrays are compared
+        with ``compare_data``; override this for data whose length may change, e.g. spike trains.
+        '''
+        return compare_data(reference, data)
 
     # User should not implement any of the following functions
     
-    def __init__(self):
+    def __init__(self, precision=None):
+        if precision is not None:
+            self.precision = precision
+        if self.precision not in ('single', 'double'):
+            raise ValueError("precision should be 'single' or 'double'")
         self.interrupted = False
         self.is_computing = False
         self.next_computation = None
         self.model_explorer = None
+        self.next_update_time = 0.0
+        self.previewing = False
+        # whether the last result returned by compute was a preview with a coarser time step
+        self.data_previewing = False
+        self.preview_dt_factor = self.max_preview_dt_factor
+        # factor by which time_step actually coarsened the time step of the last computation
+        self.effective_dt_factor = 1.0
+        self.last_preview = None
+        # statistics used by replay_session
+        self.num_interrupted = 0
+        self.num_dropped = 0
+        self.data_start_time = None
         self.basedir = os.path.expanduser('~/.brian2cookbook/tools/model_explorer/'+self.explorer_type)
         ensure_directory(self.basedir)
         
@@ -417,40 +702,155 @@ class ExplorableModel(object):
     def compute(self, **params):
         if self.is_computing:
             self.interrupted = True
+            if self.next_computation is not None:
+                self.num_dropped += 1
             self.next_computation = params
             return None
         else:
             while True:
                 self.interrupted = False
                 self.is_computing = True
+                start_time = time.time()
                 try:
-                    data = self.get_data(**params)
+                    data = self.get_data_with_precision(self.precision, **params)
                 except ModelExplorerInterruptError:
+                    self.num_interrupted += 1
+                    data = None
+                except Exception:
+                    if self.next_computation is None:
+                        # leave the model ready for the next computation
+                        self.interrupted = False
+                        self.is_computing = False
+                        raise
+                    # the parameters have changed in the meantime, compute the new ones instead
                     data = None
                 if data is None:
                     params = self.next_computation
                     self.next_computation = None
+                    if params is None:
+                        self.interrupted = False
+                        self.is_computing = False
+                        return None
                 else:
                     self.interrupted = False
                     self.is_computing = False
+                    self.data_start_time = start_time
+                    # a preview whose time step was not actually coarsened is an exact computation
+                    previewing = self.previewing and self.effective_dt_factor>1
+                    self.data_previewing = previewing
+                    self.track_preview(params, previewing, data)
                     return data
                 
+    def time_step(self, dt, max_dt=None):
+        '''
+        Returns the time step to use instead of dt, coarsened when computing a preview
+        
+        The coarsened time step is limited to ``max_dt`` (if given), e.g. a fraction of the fastest
+        time constant, but never smaller than dt. The factor actually used is stored in
+        ``effective_dt_factor``, a preview with a factor of 1 is treated as exact data.
+        '''
+        coarse_dt = dt
+        if self.previewing:
+            coarse_dt = dt*self.preview_dt_factor
+            if max_dt is not None and coarse_dt>max_dt:
+                coarse_dt = max_dt
+            if coarse_dt<dt:
+                coarse_dt = dt
+        self.effective_dt_factor = float(coarse_dt/dt)
+        return coarse_dt
+    
+    def track_preview(self, params, previewing, data):
+        '''
+        Adapts the preview time step by comparing previews with the exact data for the same parameters
+        '''
+        if previewing:
+            self.last_preview = (params, data)
+            return
+        if self.last_preview is not None and self.last_preview[0]==params:
+            self.calibrate_preview(self.last_preview[1], data)
+        self.last_preview = None
+        
+    def calibrate_preview(self, preview, data):
+        if self.preview_error_budget is None:
+            return
+        error = self.preview_error(preview, data)
+        if error is None:
+            return
+        # integer maximum and minimum rather than max and min, which are numpy's amax and amin here
+        if error>self.preview_error_budget:
+            self.preview_dt_factor = int(maximum(self.preview_dt_factor//2, 1))
+        elif error<self.preview_error_budget/4:
+            self.preview_dt_factor = int(minimum(self.preview_dt_factor*2, self.max_preview_dt_factor))
+                
+    def get_data_with_precision(self, precision, **params):
+        '''
+        Calls ``get_data`` with the given precision ('single' or 'double')
+        
+        In single precision, Brian 2 simulations use float32 and all floating point arrays in the
+        result are stored as float32. In double precision, Brian's preferences are left unchanged.
+        '''
+        self.effective_dt_factor = 1.0
+        if precision!='single':
+            return self.get_data(**params)
+        with brian_float_dtype(float32):
+            data = self.get_data(**params)
+        if data is not None:
+            data = compact_data(data, float32)
+        return data
+    
+    def validate_precision(self, **params):
+        '''
+        Runs ``get_data`` in single and double precision and compares the results
+        
+        Returns the deviations of the single precision run as computed by ``precision_deviations``.
+        '''
+        # the reference is computed in double precision, whatever Brian's preferences are
+        with brian_float_dtype(float64):
+            reference = self.get_data_with_precision('double', **params)
+        data = self.get_data_with_precision('single', **params)
+        return self.precision_deviations(reference, data)
+        
     def update(self, fraction=None):
+        if self.interrupted:
+            raise ModelExplorerInterruptError
+        if self.model_explorer is None:
+            return
+        # Only process GUI events and report progress every update_interval seconds
+        curtime = time.time()
+        if curtime<self.next_update_time:
+            return
+        self.next_update_time = curtime+self.update_interval
         QtGui.QApplication.processEvents()
-        if self.model_explorer is not None and fraction is not None:
+        if fraction is not None:
             self.model_explorer.update_complete(fraction)
         if self.interrupted:
             raise ModelExplorerInterruptError
+        
+    def run_network(self, net, duration, start_fraction=0.0, end_fraction=1.0, namespace=None):
+        '''
+        Runs the Brian network ``net`` for ``duration``, calling ``update`` between runs.
+        
+        The run is split into ``run_network_chunks`` chunks, so that Brian can run each chunk
+        without any Python callbacks. The progress reported goes from ``start_fraction`` to
+        ``end_fraction``. Since Brian looks up external constants in the namespace of the function
+        calling ``run``, they have to be given explicitly as the dict ``namespace``.
+        '''
+        chunks = int(maximum(self.run_network_chunks, 1))
+        chunk_duration = duration/chunks
+        for i in xrange(chunks):
+            self.update(start_fraction+(end_fraction-start_fraction)*float(i)/chunks)
+            net.run(chunk_duration, namespace=namespace)
+        self.update(end_fraction)
 
-    def launch_gui(self, auto_compute=True):
-        model_explorer(self, auto_compute=auto_compute)
+    def launch_gui(self, auto_compute=True, session_file=None):
+        model_explorer(self, auto_compute=auto_compute, session_file=session_file)
         
     def set_model_explorer(self, model_explorer):
         self.model_explorer = model_explorer    
 
     
-def model_explorer(model, auto_compute=True):
+def model_explorer(model, auto_compute=True, session_file=None):
     app = QtGui.QApplication(sys.argv)
-    myapp = ModelExplorer(model=model, auto_compute=auto_compute)
+    myapp = ModelExplorer(model=model, auto_compute=auto_compute, session_file=session_file)
     myapp.show()
     sys.exit(app.exec_())
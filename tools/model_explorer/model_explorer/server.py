@@ -0,0 +1,371 @@
+'''
+Computing model data in a separate server process
+
+A ``ComputeServer`` hosts ``ExplorableModel`` instances and keeps a cache of their results.
+A ``RemoteModel`` wraps a local instance of the same model (for its parameters and plotting)
+and sends its computations to the server, so it can be used in a ``ModelExplorer`` like any
+other model. Several explorer windows can share one server, possibly on another machine
+(e.g. through ssh port forwarding).
+
+Messages are sent in a compact binary framing: a JSON header describing the message, followed
+by the raw bytes of all arrays. Values can be nested tuples, lists and dicts of numbers,
+strings, arrays and Brian 2 quantities.
+'''
+from numpy import *
+
+import sys
+import json
+import select
+import socket
+import struct
+import threading
+import traceback
+from collections import OrderedDict
+
+from .model_explorer import ExplorableModel, ModelExplorerInterruptError, brian2
+from .sweep import job_id
+
+__all__ = ['ComputeServer', 'RemoteModel', 'ComputeServerError', 'serve', 'encode_message',
+           'decode_message', 'default_port']
+
+default_port = 21567
+
+# magic, header length, payload length
+frame_format = '!4sII'
+frame_magic = b'MEX1'
+frame_size = struct.calcsize(frame_format)
+
+
+class ComputeServerError(IOError):
+    '''
+    Raised by ``RemoteModel`` if the compute server cannot be reached, the connection is lost or
+    the computation failed on the server
+    '''
+    pass
+
+
+def _encode_value(value, buffers):
+    if isinstance(value, tuple):
+        return {'type': 'tuple', 'items': [_encode_value(x, buffers) for x in value]}
+    if isinstance(value, list):
+        return {'type': 'list', 'items': [_encode_value(x, buffers) for x in value]}
+    if isinstance(value, dict):
+        return {'type': 'dict', 'items': [[_encode_value(k, buffers), _encode_value(v, buffers)]
+                                          for k, v in value.items()]}
+    if isinstance(value, ndarray):
+        if value.dtype.hasobject:
+            raise TypeError('Cannot send arrays of Python objects')
+        encoded = {'type': 'array', 'index': len(buffers), 'dtype': value.dtype.str,
+                   'shape': list(value.shape)}
+        if brian2 is not None and isinstance(value, brian2.Quantity):
+            encoded['dim'] = [float(d) for d in brian2.get_dimensions(value)._dims]
+        buffers.append(ascontiguousarray(value).tobytes())
+        return encoded
+    if isinstance(value, generic):
+        value = value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {'type': 'value', 'value': value}
+    if sys.version_info[0]==2 and isinstance(value, (long, unicode)):
+        return {'type': 'value', 'value': value}
+    raise TypeError('Cannot send values of type %s' % type(value).__name__)
+
+
+def _decode_value(encoded, payload, offsets):
+    kind = encoded['type']
+    if kind=='value':
+        return encoded['value']
+    if kind=='tuple':
+        return tuple(_decode_value(x, payload, offsets) for x in encoded['items'])
+    if kind=='list':
+        return [_decode_value(x, payload, offsets) for x in encoded['items']]
+    if kind=='dict':
+        return dict((_decode_value(k, payload, offsets), _decode_value(v, payload, offsets))
+                    for k, v in encoded['items'])
+    if kind=='array':
+        arr_dtype = dtype(str(encoded['dtype']))
+        shape = tuple(encoded['shape'])
+        count = int(prod(shape))
+        if count:
+            arr = frombuffer(payload, dtype=arr_dtype, count=count, offset=offsets[encoded['index']])
+            arr = arr.reshape(shape)
+        else:
+            arr = zeros(shape, dtype=arr_dtype)
+        if 'dim' in encoded:
+            dim = brian2.units.fundamentalunits.get_or_create_dimension(encoded['dim'])
+            arr = brian2.Quantity(arr, dim=dim, copy=False)
+        return arr
+    raise ValueError('Unknown value type %s' % kind)
+
+
+def encode_message(fields, value=None):
+    '''
+    Returns the bytes of a message with the JSON-compatible dict fields and the data value
+    '''
+    buffers = []
+    header = dict(fields)
+    header['value'] = _encode_value(value, buffers)
+    header['buffers'] = [len(b) for b in buffers]
+    header = json.dumps(header, sort_keys=True).encode('utf-8')
+    payload = b''.join(buffers)
+    return struct.pack(frame_format, frame_magic, len(header), len(payload))+header+payload
+
+
+def decode_message(header, payload):
+    '''
+    Returns ``(fields, value)`` from the header and payload bytes of a message
+    '''
+    fields = json.loads(bytes(header).decode('utf-8'))
+    offsets = cumsum([0]+fields.pop('buffers'))
+    value = _decode_value(fields.pop('value'), payload, offsets)
+    return fields, value
+
+
+def _recv_exactly(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    received = 0
+    while received<n:
+        num = sock.recv_into(view[received:], n-received)
+        if num==0:
+            raise EOFError('Connection closed')
+        received += num
+    return buf
+
+
+def send_message(sock, fields, value=None):
+    sock.sendall(encode_message(fields, value))
+
+
+def recv_message(sock):
+    magic, header_size, payload_size = struct.unpack(frame_format, bytes(_recv_exactly(sock, frame_size)))
+    if magic!=frame_magic:
+        raise IOError('Invalid message')
+    header = _recv_exactly(sock, header_size)
+    # a bytearray, so that the decoded arrays are writeable
+    payload = _recv_exactly(sock, payload_size)
+    return decode_message(header, payload)
+
+
+class Connection(object):
+    '''
+    A client connection to a ``ComputeServer``
+    '''
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.cancelled = set()
+
+    def send(self, fields, value=None):
+        with self.send_lock:
+            send_message(self.sock, fields, value)
+
+    def run(self):
+        try:
+            while True:
+                fields, value = recv_message(self.sock)
+                if fields['op']=='compute':
+                    thread = threading.Thread(target=self.server.compute_request,
+                                              args=(self, fields, value))
+                    thread.daemon = True
+                    thread.start()
+                elif fields['op']=='cancel':
+                    self.cancelled.add(fields['id'])
+                    self.server.cancel(self, fields['id'])
+        except (EOFError, socket.error):
+            pass
+        finally:
+            self.server.cancel(self)
+            self.sock.close()
+
+
+class ComputeServer(object):
+    '''
+    Serves computations of models (``ExplorableModel`` instances) to ``RemoteModel`` clients
+
+    Computations are run one at a time, since Brian uses global state. The last ``cache_size``
+    results are kept, and sent again without computation for the same parameters.
+    '''
+    def __init__(self, models, host='localhost', port=default_port, cache_size=32):
+        self.models = dict((model.explorer_type, model) for model in models)
+        self.address = (host, port)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.compute_lock = threading.Lock()
+        # (connection, request id, model) of the running computation
+        self.running = None
+
+    def serve_forever(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.address)
+        listener.listen(5)
+        try:
+            while True:
+                sock, _ = listener.accept()
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                connection = Connection(self, sock)
+                thread = threading.Thread(target=connection.run)
+                thread.daemon = True
+                thread.start()
+        finally:
+            listener.close()
+
+    def cached(self, key):
+        with self.cache_lock:
+            if key in self.cache:
+                data = self.cache.pop(key)
+                self.cache[key] = data
+                return True, data
+        return False, None
+
+    def store(self, key, data):
+        with self.cache_lock:
+            self.cache[key] = data
+            while len(self.cache)>self.cache_size:
+                self.cache.popitem(last=False)
+
+    def cancel(self, connection, request_id=None):
+        '''
+        Interrupts the running computation if it was requested by connection (with request_id)
+        '''
+        running = self.running
+        if running is not None and running[0] is connection and request_id in (None, running[1]):
+            running[2].interrupted = True
+
+    def compute_request(self, connection, fields, params):
+        request_id = fields['id']
+        dt_factor = fields.get('dt_factor', 1)
+        reply = {'id': request_id, 'status': 'ok'}
+        data = None
+        try:
+            model = self.models[fields['model']]
+            key = (fields['model'], dt_factor, job_id(params))
+            # the data is cached with the factor by which its time step was actually coarsened
+            found, result = self.cached(key)
+            if not found:
+                with self.compute_lock:
+                    if request_id in connection.cancelled:
+                        raise ModelExplorerInterruptError
+                    found, result = self.cached(key)
+                    if not found:
+                        self.running = (connection, request_id, model)
+                        model.interrupted = False
+                        model.previewing = dt_factor>1
+                        model.preview_dt_factor = dt_factor
+                        try:
+                            data = model.get_data_with_precision(model.precision, **params)
+                        finally:
+                            self.running = None
+                            model.previewing = False
+                        if data is None:
+                            raise ModelExplorerInterruptError
+                        result = (data, model.effective_dt_factor)
+                        self.store(key, result)
+            data, reply['dt_factor'] = result
+        except ModelExplorerInterruptError:
+            reply['status'] = 'interrupted'
+            data = None
+        except Exception:
+            # the client only reports the error, the traceback is shown here
+            traceback.print_exc()
+            reply['status'] = 'error'
+            reply['message'] = traceback.format_exception_only(*sys.exc_info()[:2])[-1].strip()
+            data = None
+        connection.cancelled.discard(request_id)
+        try:
+            connection.send(reply, data)
+        except socket.error:
+            pass
+
+
+class RemoteModel(ExplorableModel):
+    '''
+    Computes the data of model on a ``ComputeServer`` hosting the same model
+
+    The local model instance is only used for its parameters and plotting.
+    '''
+    def __init__(self, model, host='localhost', port=default_port):
+        self.model = model
+        self.explorer_type = model.explorer_type
+        self.plot_styles = model.plot_styles
+        self.param_specs = model.param_specs
+        self.preview = model.preview
+        self.refine_delay = model.refine_delay
+        self.max_preview_dt_factor = model.max_preview_dt_factor
+        self.preview_error_budget = model.preview_error_budget
+        ExplorableModel.__init__(self)
+        self.address = (host, port)
+        self.sock = None
+        self.request_id = 0
+
+    def connection(self):
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self.sock
+
+    def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def get_data(self, **params):
+        # A lost connection is expected (e.g. if the server is restarted), the next computation
+        # connects again
+        try:
+            return self.request_data(params)
+        except ComputeServerError:
+            raise
+        except (socket.error, EOFError, IOError) as e:
+            self.disconnect()
+            raise ComputeServerError('No connection to the compute server at %s:%d (%s)'
+                                     % (self.address[0], self.address[1], e))
+
+    def request_data(self, params):
+        sock = self.connection()
+        self.request_id += 1
+        request_id = self.request_id
+        if self.previewing:
+            dt_factor = self.preview_dt_factor
+        else:
+            dt_factor = 1
+        send_message(sock, {'op': 'compute', 'id': request_id, 'model': self.explorer_type,
+                            'dt_factor': dt_factor}, params)
+        while True:
+            try:
+                self.update()
+            except ModelExplorerInterruptError:
+                send_message(sock, {'op': 'cancel', 'id': request_id})
+                raise
+            readable, _, _ = select.select([sock], [], [], self.update_interval)
+            if not readable:
+                continue
+            fields, data = recv_message(sock)
+            if fields['id']!=request_id:
+                # reply to an earlier, interrupted request
+                continue
+            if fields['status']=='ok':
+                self.effective_dt_factor = fields['dt_factor']
+                return data
+            elif fields['status']=='interrupted':
+                raise ModelExplorerInterruptError
+            else:
+                raise ComputeServerError('Computation failed on the server: '+fields['message'])
+
+    def plot_data(self, fig, style, data):
+        return self.model.plot_data(fig, style, data)
+
+    def preview_error(self, preview, data):
+        return self.model.preview_error(preview, data)
+
+
+def serve(models, host='localhost', port=default_port, cache_size=32):
+    '''
+    Runs a ``ComputeServer`` for models until interrupted
+    '''
+    ComputeServer(models, host=host, port=port, cache_size=cache_size).serve_forever()
@@ -0,0 +1,147 @@
+'''
+Replaying recorded model explorer sessions to benchmark interaction latency
+
+Record a session with ``model.launch_gui(session_file='session.txt')``, and replay it
+against any model with the same parameters with ``replay_session(model, 'session.txt')``.
+The explorer window is not shown during the replay, but Qt 4 still needs a display: on a
+machine without one (e.g. a CI server) use a virtual X server, e.g. ``xvfb-run python ...``.
+'''
+from numpy import *
+
+import os
+import sys
+import json
+import time
+
+from PyQt4 import QtCore, QtGui
+
+from .model_explorer import ModelExplorer
+
+__all__ = ['load_session', 'replay_session', 'SessionReplay']
+
+#: events that are replayed, events that require a new computation
+replayed_events = ['initial_compute', 'param_changed', 'load_parameters', 'change_plot_style']
+compute_events = ['initial_compute', 'param_changed', 'load_parameters']
+
+
+def load_session(filename):
+    '''
+    Returns the list of events recorded in a session file
+    '''
+    events = []
+    for line in open(filename, 'r'):
+        line = line.strip()
+        if line:
+            events.append(json.loads(line))
+    return events
+
+
+class EventDispatcher(object):
+    def __init__(self, replay, event):
+        self.replay = replay
+        self.event = event
+
+    def __call__(self):
+        self.replay.dispatch(self.event)
+
+
+class SessionReplay(object):
+    '''
+    Replays the events of a session in a ``ModelExplorer`` with the original timing
+
+    The timeline is divided by ``speed``. Use ``statistics()`` once the replay has finished.
+    '''
+    def __init__(self, explorer, events, speed=1.0):
+        self.explorer = explorer
+        self.model = explorer.model
+        self.events = [event for event in events if event['event'] in replayed_events]
+        self.speed = speed
+        self.num_dispatched = 0
+        self.num_plots = 0
+        # (dispatch time, requires computation) of events not yet shown in a plot
+        self.pending = []
+        self.latencies = []
+        self.finished = False
+
+    def start(self):
+        self.start_num_interrupted = self.model.num_interrupted
+        self.start_num_dropped = self.model.num_dropped
+        self.explorer.plot_listeners.append(self.plot_updated)
+        for event in self.events:
+            QtCore.QTimer.singleShot(int(1000*event['time']/self.speed), EventDispatcher(self, event))
+        self.check_finished()
+
+    def dispatch(self, event):
+        name = event['event']
+        self.pending.append((time.time(), name in compute_events))
+        self.num_dispatched += 1
+        if name=='initial_compute':
+            self.explorer.compute_data()
+        elif name=='param_changed':
+            self.explorer.param_changed(event['name'], event['value'])
+        elif name=='load_parameters':
+            self.explorer.set_parameters(self.explorer.decode_params(event['params']))
+        elif name=='change_plot_style':
+            self.explorer.change_plot_style(event['style'])
+
+    def plot_updated(self):
+        # An event is shown once a plot is drawn from data whose computation started after it
+        curtime = time.time()
+        data_start_time = self.model.data_start_time
+        self.num_plots += 1
+        pending = []
+        for event_time, needs_compute in self.pending:
+            if not needs_compute or (data_start_time is not None and event_time<=data_start_time):
+                self.latencies.append(curtime-event_time)
+            else:
+                pending.append((event_time, needs_compute))
+        self.pending = pending
+
+    def check_finished(self):
+        busy = (self.num_dispatched<len(self.events) or self.model.is_computing or
+                self.explorer.refine_timer.isActive())
+        if busy:
+            QtCore.QTimer.singleShot(100, self.check_finished)
+        else:
+            self.finished = True
+            QtGui.QApplication.instance().quit()
+
+    def statistics(self):
+        '''
+        Returns a dict with the time-to-plot percentiles (in seconds), the number of interrupted
+        (wasted) computations, of dropped updates (queued computations replaced by a newer one
+        before they started), and of events that were never shown in a plot.
+        '''
+        stats = {'events': len(self.events),
+                 'plots': self.num_plots,
+                 'interrupted': self.model.num_interrupted-self.start_num_interrupted,
+                 'dropped': self.model.num_dropped-self.start_num_dropped,
+                 'unanswered': len(self.pending),
+                 }
+        for p in [50, 95, 99]:
+            if len(self.latencies):
+                stats['p%d' % p] = percentile(array(self.latencies), p)
+            else:
+                stats['p%d' % p] = nan
+        return stats
+
+
+def replay_session(model, filename, speed=1.0):
+    '''
+    Replays a recorded session against model and returns ``SessionReplay.statistics()``
+
+    The explorer window is not shown, but on X11 a display is required (Qt 4 has no offscreen
+    platform), use e.g. ``xvfb-run`` on machines without one.
+    '''
+    app = QtGui.QApplication.instance()
+    if app is None:
+        x11 = not sys.platform.startswith('win') and sys.platform!='darwin'
+        if x11 and not os.environ.get('DISPLAY'):
+            raise RuntimeError('Replaying a session requires a display, run it with a virtual '
+                               'X server, e.g. "xvfb-run python script.py"')
+        app = QtGui.QApplication(sys.argv)
+    explorer = ModelExplorer(model=model, auto_compute=True)
+    replay = SessionReplay(explorer, load_session(filename), speed=speed)
+    QtCore.QTimer.singleShot(0, replay.start)
+    app.exec_()
+    return replay.statistics()
@@ -0,0 +1,309 @@
+'''
+Parameter sweeps through a job queue on a shared file system
+
+Jobs (parameter dicts of an ``ExplorableModel``) are stored as files in a directory that all
+worker processes can access, on one or several machines. Workers claim jobs by atomically
+renaming them, so no other communication is needed. Layout of the directory::
+
+    pending/<id>.job    parameters of jobs waiting for a worker
+    claimed/<id>.<claim>.job    jobs being computed, touched regularly by their worker
+    results/<id>.pkl    (params, data) of finished jobs
+    done/<id>           completion markers
+    failed/<id>         tracebacks of jobs that raised an error
+
+Each claim has a unique name, so a worker only ever removes its own claim. Claims that have not
+been touched for ``stale_timeout`` seconds (e.g. because the worker died) are put back into
+``pending``. Enqueuing is resumable: jobs that are done, pending or claimed
+are not enqueued again.
+'''
+import os
+import time
+import socket
+import pickle
+import random
+import uuid
+import hashlib
+import threading
+import traceback
+import itertools
+import multiprocessing
+
+import numpy
+
+from .model_explorer import Parameter, BooleanParameter, ensure_directory, brian2
+
+__all__ = ['SweepQueue', 'job_id', 'default_params', 'parameter_grid', 'run_worker',
+           'run_local_workers']
+
+
+def _canonical_value(value):
+    # a representation that does not depend on the numpy or Brian version
+    if isinstance(value, (bool, numpy.bool_)):
+        return 'bool:%s' % bool(value)
+    if isinstance(value, (str, type(u''))):
+        return 'str:'+value
+    if brian2 is not None and isinstance(value, brian2.Quantity):
+        dims = ','.join(repr(float(d)) for d in brian2.get_dimensions(value)._dims)
+        return 'float:%r:%s' % (float(numpy.asarray(value)), dims)
+    return 'float:%r' % float(numpy.asarray(value))
+
+
+def job_id(params):
+    '''
+    Returns an identifier for a parameter dict, the same on every machine
+    
+    Numbers are identified by their value (in SI units) and physical dimensions, not by their type,
+    e.g. ``1`` and ``1.0`` give the same id. Booleans are distinct from numbers.
+    '''
+    canonical = '\n'.join('%s=%s' % (name, _canonical_value(params[name]))
+                           for name in sorted(params.keys()))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def default_params(model):
+    '''
+    Returns the dict of the start values of all parameters of model
+    '''
+    params = {}
+    for spec in model.param_specs:
+        if isinstance(spec, (Parameter, BooleanParameter)):
+            params[spec.name] = spec.start
+    return params
+
+
+def parameter_grid(base, **values):
+    '''
+    Returns a list of parameter dicts, one for each combination of values
+
+    ``base`` gives the values of the parameters that are not varied, e.g.
+    ``parameter_grid(default_params(model), a=[0.0, 1.0], b=[10*mV, 20*mV])``.
+    '''
+    names = sorted(values.keys())
+    grid = []
+    for combination in itertools.product(*[values[name] for name in names]):
+        params = base.copy()
+        params.update(zip(names, combination))
+        grid.append(params)
+    return grid
+
+
+class Heartbeat(object):
+    '''
+    Touches a file every interval seconds in a background thread until stopped
+    '''
+    def __init__(self, filename, interval):
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.filename, None)
+            except OSError:
+                # the claim was recovered by another worker
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class SweepQueue(object):
+    '''
+    A job queue stored in directory, see the module documentation
+    '''
+    def __init__(self, directory, stale_timeout=600.0, heartbeat_interval=30.0):
+        self.directory = directory
+        self.stale_timeout = stale_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_name = '%s.%d' % (socket.gethostname(), os.getpid())
+        for subdir in ['pending', 'claimed', 'results', 'done', 'failed', 'tmp']:
+            ensure_directory(os.path.join(directory, subdir))
+
+    def path(self, subdir, name=''):
+        return os.path.join(self.directory, subdir, name)
+
+    def write_atomic(self, filename, obj):
+        # rename is atomic, so other processes never see a partially written file
+        tmpname = self.path('tmp', '%s.%s' % (os.path.basename(filename), self.worker_name))
+        f = open(tmpname, 'wb')
+        try:
+            pickle.dump(obj, f, -1)
+        finally:
+            f.close()
+        os.rename(tmpname, filename)
+
+    def job_ids(self, subdir):
+        # the id is the part of the file name before the first dot
+        return [name.split('.', 1)[0] for name in os.listdir(self.path(subdir))]
+
+    def is_done(self, jid):
+        return os.path.exists(self.path('done', jid))
+
+    def enqueue(self, params_list):
+        '''
+        Adds jobs for each parameter dict in params_list, returns the list of their ids
+        '''
+        known = set(self.job_ids('pending'))|set(self.job_ids('claimed'))|set(self.job_ids('done'))
+        ids = []
+        for params in params_list:
+            jid = job_id(params)
+            ids.append(jid)
+            if jid not in known:
+                self.write_atomic(self.path('pending', jid+'.job'), params)
+                known.add(jid)
+        return ids
+
+    def claim(self):
+        '''
+        Claims a pending job, returns ``(id, params, claim)`` or None if no job is pending
+        '''
+        pending = self.job_ids('pending')
+        # random order, so that workers rarely compete for the same job
+        random.shuffle(pending)
+        for jid in pending:
+            claim = '%s.%s.job' % (jid, uuid.uuid4().hex)
+            pending_file = self.path('pending', jid+'.job')
+            claimed = self.path('claimed', claim)
+            try:
+                # A rename keeps the modification time, so the job is touched before it is moved:
+                # otherwise a job that waited longer than stale_timeout would be stale at once
+                os.utime(pending_file, None)
+                os.rename(pending_file, claimed)
+            except OSError:
+                # claimed by another worker
+                continue
+            if self.is_done(jid):
+                # finished by a worker whose claim was considered stale
+                self.release(claim)
+                continue
+            try:
+                f = open(claimed, 'rb')
+                try:
+                    params = pickle.load(f)
+                finally:
+                    f.close()
+            except (OSError, IOError):
+                # recovered as stale by another worker in the meantime
+                continue
+            return jid, params, claim
+        return None
+
+    def release(self, claim):
+        # if the claim was recovered as stale in the meantime, it no longer exists under this name
+        try:
+            os.remove(self.path('claimed', claim))
+        except OSError:
+            pass
+
+    def file_system_time(self):
+        # the clock of the file system, which may differ from the clocks of the worker machines
+        probe = self.path('tmp', 'clock.'+self.worker_name)
+        open(probe, 'w').close()
+        mtime = os.stat(probe).st_mtime
+        os.remove(probe)
+        return mtime
+
+    def recover_stale(self):
+        '''
+        Puts claimed jobs that have not been touched for ``stale_timeout`` back into pending
+        '''
+        now = self.file_system_time()
+        recovered = 0
+        for claim in os.listdir(self.path('claimed')):
+            jid = claim.split('.', 1)[0]
+            claimed = self.path('claimed', claim)
+            try:
+                if now-os.stat(claimed).st_mtime<self.stale_timeout:
+                    continue
+                os.rename(claimed, self.path('pending', jid+'.job'))
+                recovered += 1
+            except OSError:
+                # finished or recovered in the meantime
+                pass
+        return recovered
+
+    def run_job(self, model, jid, params, claim):
+        '''
+        Computes a claimed job with model and stores the result (or the traceback on failure)
+        '''
+        heartbeat = Heartbeat(self.path('claimed', claim), self.heartbeat_interval)
+        try:
+            model.interrupted = False
+            data = model.get_data_with_precision(model.precision, **params)
+        except Exception:
+            f = open(self.path('failed', jid), 'w')
+            f.write(traceback.format_exc())
+            f.close()
+            return False
+        else:
+            self.write_atomic(self.path('results', jid+'.pkl'), (params, data))
+            open(self.path('done', jid), 'w').close()
+            if os.path.exists(self.path('failed', jid)):
+                os.remove(self.path('failed', jid))
+            return True
+        finally:
+            heartbeat.stop()
+            self.release(claim)
+
+    def status(self):
+        '''
+        Returns a dict with the number of pending, claimed, done and failed jobs
+        '''
+        return dict((subdir, len(os.listdir(self.path(subdir))))
+                    for subdir in ['pending', 'claimed', 'done', 'failed'])
+
+    def is_finished(self):
+        return not os.listdir(self.path('pending')) and not os.listdir(self.path('claimed'))
+
+    def results(self):
+        '''
+        Yields ``(id, params, data)`` for each finished job
+        '''
+        for jid in sorted(self.job_ids('done')):
+            f = open(self.path('results', jid+'.pkl'), 'rb')
+            try:
+                params, data = pickle.load(f)
+            finally:
+                f.close()
+            yield jid, params, data
+
+
+def run_worker(model, directory, wait=True, poll_interval=1.0, **kwds):
+    '''
+    Computes jobs from the queue in directory with model, returns the number of jobs computed
+
+    If ``wait`` is True, the worker keeps polling until no job is pending or claimed, so that it
+    can take over jobs of workers that died. Other keywords are passed to ``SweepQueue``.
+    '''
+    queue = SweepQueue(directory, **kwds)
+    num_jobs = 0
+    while True:
+        job = queue.claim()
+        if job is None and queue.recover_stale():
+            job = queue.claim()
+        if job is None:
+            if wait and not queue.is_finished():
+                time.sleep(poll_interval)
+                continue
+            return num_jobs
+        queue.run_job(model, *job)
+        num_jobs += 1
+
+
+def run_local_workers(model, directory, processes=None, **kwds):
+    '''
+    Runs ``run_worker`` in several processes on this machine (by default, one per CPU)
+    '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    workers = [multiprocessing.Process(target=run_worker, args=(model, directory), kwargs=kwds)
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()